@@ -190,7 +190,9 @@ def render_features_from_text(input_text: str):
     try:
         expression: MathExpression = parser.parse(input_text)
         state = MathyEnvState(problem=input_text)
-        observation: MathyObservation = state.to_observation(hash_type=[13, 37])
+        observation: MathyObservation = state.to_observation(
+            hash_type=[13, 37], parser=parser
+        )
 
         length = len(observation.nodes)
         types = observation.nodes
@@ -1,5 +1,6 @@
 """Use Fractal Monte Carlo search in order to solve mathy problems without a
 trained neural network."""
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Union
 
 import numpy as np
@@ -8,15 +9,22 @@ from fragile.core.models import DiscreteModel
 from fragile.core.states import StatesEnv, StatesModel, StatesWalkers
 from fragile.core.swarm import Swarm
 from fragile.core.tree import HistoryTree
+from fragile.core.utils import StateDict
 from fragile.distributed.env import ParallelEnv
-from mathy_core import MathTypeKeysMax
 from mathy_envs import EnvRewards, MathyEnv, MathyEnvState
 from pydantic import BaseModel
 from wasabi import msg
 
 
+# The fixed length that MathyEnvState strings are padded to when stored as arrays
+STATE_SIZE = 2048
+# State strings are ASCII text, so one byte per character is enough to store them
+STATE_DTYPE = np.uint8
+
+
 class SwarmConfig(BaseModel):
     use_mp: bool = True
+    n_workers: int = 8
     history: bool = False
     history_names: List[str] = ["states", "actions", "rewards"]
     single_problem: bool = False
@@ -29,6 +37,42 @@ def mathy_dist(x: np.ndarray, y: np.ndarray) -> np.ndarray:
     return np.linalg.norm(x - y, axis=1)
 
 
+def state_to_np(state: MathyEnvState) -> np.ndarray:
+    """Encode a MathyEnvState as a fixed-size array of ASCII character codes.
+
+    The padded text is viewed directly as bytes rather than converted one
+    character at a time with `ord`."""
+    text = state.to_string()
+    assert len(text) <= STATE_SIZE, "state is larger than STATE_SIZE!"
+    return np.frombuffer(text.ljust(STATE_SIZE).encode("ascii"), dtype=STATE_DTYPE)
+
+
+@lru_cache(maxsize=4096)
+def _decode_state(data: bytes) -> MathyEnvState:
+    return MathyEnvState.from_string(data.decode("ascii"))
+
+
+def state_from_np(state: np.ndarray) -> MathyEnvState:
+    """Decode a swarm state array into a MathyEnvState.
+
+    Walkers are cloned during balancing so the same states are decoded many
+    times per epoch. Recently seen states are cached by their raw bytes and
+    the cached instance is returned without a copy, so callers must not modify
+    it. This is safe for env transitions because they always copy the state
+    before appending to its history."""
+    return _decode_state(state.astype(STATE_DTYPE, copy=False).tobytes())
+
+
+def random_choice_prob_index(
+    probs: np.ndarray, random_state: np.random.RandomState, axis: int = 1
+) -> np.ndarray:
+    """Select random actions with probabilities across a batch.
+
+    Source: https://stackoverflow.com/a/47722393/287335"""
+    r = np.expand_dims(random_state.rand(probs.shape[1 - axis]), axis=axis)
+    return (probs.cumsum(axis=axis) > r).argmax(axis=axis)
+
+
 class DiscreteMasked(DiscreteModel):
     def sample(
         self,
@@ -38,19 +82,12 @@ class DiscreteMasked(DiscreteModel):
         walkers_states: StatesWalkers = None,
         **kwargs,
     ) -> StatesModel:
-        def random_choice_prob_index(a, axis=1):
-            """Select random actions with probabilities across a batch.
-            
-            Source: https://stackoverflow.com/a/47722393/287335"""
-            r = np.expand_dims(self.random_state.rand(a.shape[1 - axis]), axis=axis)
-            return (a.cumsum(axis=axis) > r).argmax(axis=axis)
-
         if env_states is not None:
             # Each state is a vstack([node_ids, mask]) and we only want the mask.
             #
             # Swap columns and slice the last element to get it.
             masks = env_states.observs[:, -self.n_actions :]
-            actions = random_choice_prob_index(masks)
+            actions = random_choice_prob_index(masks, self.random_state)
         else:
             actions = self.random_state.randint(0, self.n_actions, size=batch_size)
         return self.update_states_with_critic(
@@ -84,13 +121,18 @@ class FragileMathyEnv(DiscreteEnv):
         )
         self._n_actions = self._env.action_space.n
         super(DiscreteEnv, self).__init__(
-            states_shape=self._env.get_state().shape,
+            states_shape=(STATE_SIZE,),
             observs_shape=self._env.observation_space.shape,
         )
 
     def __getattr__(self, item):
         return getattr(self._env, item)
 
+    def get_params_dict(self) -> StateDict:
+        params = super(FragileMathyEnv, self).get_params_dict()
+        params["states"]["dtype"] = STATE_DTYPE
+        return params
+
     def make_transitions(
         self, states: np.ndarray, actions: np.ndarray, dt: Union[np.ndarray, int]
     ) -> Dict[str, np.ndarray]:
@@ -103,10 +145,10 @@ class FragileMathyEnv(DiscreteEnv):
         )
         terminals = [inf.get("done", False) for inf in infos]
         data = {
-            "states": np.array(new_states),
-            "observs": np.array(observs),
-            "rewards": np.array(rewards),
-            "oobs": np.array(oobs),
+            "states": np.asarray(new_states),
+            "observs": np.asarray(observs),
+            "rewards": np.asarray(rewards),
+            "oobs": np.asarray(oobs),
             "terminals": np.array(terminals),
         }
         return data
@@ -137,21 +179,21 @@ class FragileEnvironment:
             mask_as_probabilities=True,
             **kwargs,
         )
-        self.observation_space = spaces.Box(
-            low=0, high=MathTypeKeysMax, shape=(256, 256, 1), dtype=np.uint8,
-        )
+        # Use the flat observation vector that the gym env actually produces so
+        # fragile doesn't allocate a [n_walkers, 256, 256, 1] placeholder for
+        # every batch of walker states.
+        self.observation_space = self._env.observation_space
         self.action_space = spaces.Discrete(self._env.action_size)
         self.problem = problem
         self.max_steps = max_steps
-        self._env.reset()
 
     def get_state(self) -> np.ndarray:
         assert self._env.state is not None, "env required to get_state"
-        return self._env.state.to_np(2048)
+        return state_to_np(self._env.state)
 
     def set_state(self, state: np.ndarray):
         assert self._env is not None, "env required to set_state"
-        self._env.state = MathyEnvState.from_np(state)
+        self._env.state = state_from_np(state)
         return state
 
     def step(self, action: int, state: np.ndarray = None) -> tuple:
@@ -166,16 +208,22 @@ class FragileEnvironment:
     def step_batch(
         self, actions, states:Optional[Any]=None, n_repeat_action: Optional[Union[int, np.ndarray]] = None
     ) -> tuple:
-        data = [self.step(action, state) for action, state in zip(actions, states)]
-        new_states, observs, rewards, terminals, infos = [], [], [], [], []
-        for d in data:
-            new_state, obs, _reward, end, info = d
-            new_states.append(new_state)
-            observs.append(obs)
-            rewards.append(_reward)
-            terminals.append(end)
+        # Write each walker's step directly into contiguous per-field arrays
+        # rather than collecting per-walker lists that have to be stacked later.
+        n_walkers = len(actions)
+        new_states = np.empty((n_walkers, STATE_SIZE), dtype=STATE_DTYPE)
+        observs = np.empty(
+            (n_walkers,) + self.observation_space.shape, dtype=np.float32
+        )
+        rewards = np.empty(n_walkers, dtype=np.float32)
+        oobs = np.empty(n_walkers, dtype=np.bool_)
+        infos = []
+        for i, (action, state) in enumerate(zip(actions, states)):
+            new_states[i], observs[i], rewards[i], oobs[i], info = self.step(
+                action, state
+            )
             infos.append(info)
-        return new_states, observs, rewards, terminals, infos
+        return new_states, observs, rewards, oobs, infos
 
     def reset(self, batch_size: int = 1):
         assert self._env is not None, "env required to reset"
@@ -189,7 +237,9 @@ def mathy_swarm(config: SwarmConfig, env_callable=None) -> Swarm:
             name="mathy_v0", repeat_problem=config.single_problem
         )
     if config.use_mp:
-        env_callable = ParallelEnv(env_callable=env_callable)
+        env_callable = ParallelEnv(
+            env_callable=env_callable, n_workers=config.n_workers
+        )
     tree_callable = None
     if config.history:
         tree_callable = lambda: HistoryTree(prune=True, names=config.history_names)
@@ -234,8 +284,13 @@ def swarm_solve(
             max_steps=current_max_moves,
         )
 
-    mathy_env: MathyEnv = env_callable()._env._env.mathy
-    swarm: Swarm = mathy_swarm(config, env_callable)
+    # Reuse the env built for printing as the swarm env when running in a single
+    # process, rather than constructing (and generating a problem for) another.
+    local_env = env_callable()
+    mathy_env: MathyEnv = local_env._env._env.mathy
+    swarm: Swarm = mathy_swarm(
+        config, env_callable if config.use_mp else lambda: local_env
+    )
     while True:
         if not silent:
             with msg.loading(f"Solving {current_problem} ..."):
@@ -245,7 +300,7 @@ def swarm_solve(
 
         if not silent:
             if swarm.walkers.best_reward > EnvRewards.WIN:
-                last_state = MathyEnvState.from_np(swarm.walkers.states.best_state)
+                last_state = state_from_np(swarm.walkers.states.best_state)
                 msg.good(f"Solved! {current_problem} = {last_state.agent.problem}")
                 mathy_env.print_history(last_state)
             else:
@@ -65,3 +65,9 @@ def test_cli_simplify_swarm(use_mp: bool):
         args.append("--single-process")
     result = runner.invoke(cli, args)
     assert result.exit_code == 0
+
+
+def test_cli_simplify_num_workers():
+    runner = CliRunner()
+    result = runner.invoke(cli, ["simplify", "4x + 2x", "--num-workers=2"])
+    assert result.exit_code == 0